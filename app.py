@@ -1,21 +1,49 @@
 import os
+import re
+import gc
+import gzip
 import uuid
 import json
+import click
+import time
+import cProfile
+import multiprocessing
+import hashlib
 import requests
+import threading
 import pandas as pd
-from datetime import datetime, timedelta
-from functools import wraps
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import wraps, lru_cache
 
 from flask import (
     Flask, render_template, request, redirect,
-    url_for, flash, jsonify, session,send_file
+    url_for, flash, jsonify, session,send_file, g,
+    has_request_context, send_from_directory, abort,
+    before_render_template, template_rendered
 )
 from io import BytesIO
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
 app = Flask(__name__)
-app.secret_key = 'replace-with-a-secure-random-key'
+DEV_SECRET_KEY = 'replace-with-a-secure-random-key'
+app.secret_key = os.environ.get('SECRET_KEY', DEV_SECRET_KEY)
 EXCEL_FILE = os.path.join('Data', 'freelance_organizer.xlsx')
+PROFILE_DIR   = os.path.join('Data', 'profiles')
+PAYMENTS_FILE = os.path.join('Data', 'payments.xlsx')
+ARCHIVE_FILE  = os.path.join('Data', 'archive.xlsx')
+ARCHIVE_META  = os.path.join('Data', 'archive.json')
+ARCHIVE_HORIZON_DAYS = int(os.environ.get('ARCHIVE_HORIZON_DAYS', 365))
 
 # ── Exchange Rate Caching ─────────────────────────────────────────────────────
 _exchange_cache: dict[str, tuple[float, datetime]] = {}
@@ -47,12 +75,13 @@ CURRENCY_FILE = os.path.join(app.root_path, 'static', 'currencies.json')
 with open(CURRENCY_FILE, 'r', encoding='utf-8') as f:
     _CURRENCY_DATA = json.load(f)
 
-def get_currency_list() -> list[tuple[str,str]]:
-    """Return sorted list of (code, name) from currencies.json."""
-    return sorted(
+@lru_cache(maxsize=None)
+def get_currency_list() -> tuple[tuple[str,str], ...]:
+    """Return sorted (code, name) pairs from currencies.json, built once."""
+    return tuple(sorted(
         [(code, info.get('name','')) for code, info in _CURRENCY_DATA.items()],
         key=lambda x: x[0]
-    )
+    ))
 
 def get_currency_symbol(code: str) -> str:
     code = str(code) + ''
@@ -65,40 +94,129 @@ app.jinja_env.globals['get_currency_symbol'] = get_currency_symbol
 def inject_user_currencies():
     report_code = 'USD'
     payout_code = 'USD'
+    admin       = False
     if session.get('user_id'):
         _, _, _, users = load_data()
         row = users[users.id == session['user_id']]
         if not row.empty:
             report_code = row.iloc[0].currency or 'USD'
             payout_code = row.iloc[0].pay_currency or report_code
+            admin       = is_truthy(row.iloc[0].is_admin)
     return {
         'report_currency': report_code,
         'report_symbol':   get_currency_symbol(report_code),
         'payout_currency': payout_code,
         'payout_symbol':   get_currency_symbol(payout_code),
+        'is_admin':        admin,
     }
 
 # ── Data I/O ─────────────────────────────────────────────────────────────────
+def record_phase(name: str, seconds: float):
+    """Add one call to g.phase_timings (only present on profiled requests)."""
+    phase = g.phase_timings.setdefault(name, {'calls': 0, 'ms': 0.0})
+    phase['calls'] += 1
+    phase['ms']    += seconds * 1000
+
+def timed_phase(name: str):
+    """Time the wrapped call as `name` when the current request is profiled."""
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if not has_request_context() or 'phase_timings' not in g:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                record_phase(name, time.perf_counter() - start)
+        return wrapped
+    return decorator
+
+# Parsed workbook for the current data_version(). Loaded in the master before
+# forking (see create_app), so workers share it copy-on-write until it changes.
+_snapshot: dict[str, tuple] = {}
+
+# Per-user digests of the snapshot, and when this process first saw each one.
+_user_versions: dict[str, dict[str, str]] = {}
+_user_version_seen: dict[str, tuple[str, datetime | None]] = {}
+
+def current_frames():
+    """(data_version, parsed sheets) shared by every request: never mutate them."""
+    version = data_version()
+    frames  = _snapshot.get(version)
+    if frames is None:
+        frames = read_workbook()
+        _snapshot.clear()
+        _snapshot[version] = frames
+    return version, frames
+
+@timed_phase('load_data')
 def load_data():
-    client_cols = ['ClientID','ClientName','ParentID','PaymentType','PaymentAmount','IsDeleted','user_id']
-    task_cols   = ['TaskID','ClientID','TaskDescription','CreatedDate','Status','ShortName','IsDeleted','user_id']
-    ts_cols     = ['EntryID','TaskID','Date','Hours','Description','Paid','IsDeleted','user_id']
-    user_cols   = ['id','name','email','password_hash','currency','pay_currency','created_at','last_login','is_admin','status','lang_pref']
-
+    """Copies of the parsed sheets; the workbook is only re-read when it changed."""
+    _, frames = current_frames()
+    return tuple(df.copy() for df in frames)
+
+def hash_user_rows(frames) -> dict[str, str]:
+    """One order-independent digest per user over their rows in every sheet."""
+    hashes, owners = [], []
+    for df, owner in zip(frames, ('user_id', 'user_id', 'user_id', 'id')):
+        hashes.append(pd.util.hash_pandas_object(df.astype(str), index=False))
+        owners.append(df[owner].astype(str))
+    sums = pd.concat(hashes, ignore_index=True).groupby(
+        pd.concat(owners, ignore_index=True).values
+    ).sum()
+    return {uid: f'{int(h):016x}' for uid, h in sums.items()}
+
+def user_data_version(user_id) -> str:
+    """
+    Digest of one user's rows. Unlike data_version() it only moves when
+    that user's data does, so other tenants' writes (or logins) leave it alone.
+    """
+    return user_data_versions().get(str(user_id), '0')
+
+def user_data_versions() -> dict[str, str]:
+    """user_data_version() for every user in the current snapshot."""
+    version, frames = current_frames()
+    digests = _user_versions.get(version)
+    if digests is None:
+        digests = hash_user_rows(frames)
+        _user_versions.clear()
+        _user_versions[version] = digests
+    return digests
+
+def user_data_mtime(user_id) -> datetime | None:
+    """
+    Last-Modified for a user's pages: the workbook mtime when this process
+    first saw their current digest (their rows can't be newer than that).
+    """
+    digest = user_data_version(user_id)
+    seen   = _user_version_seen.get(user_id)
+    if seen is None or seen[0] != digest:
+        seen = (digest, data_mtime())
+        _user_version_seen[user_id] = seen
+    return seen[1]
+
+CLIENT_COLS = ['ClientID','ClientName','ParentID','PaymentType','PaymentAmount','IsDeleted','user_id']
+TASK_COLS   = ['TaskID','ClientID','TaskDescription','CreatedDate','Status','ShortName','IsDeleted','user_id']
+TS_COLS     = ['EntryID','TaskID','Date','Hours','Description','Paid','IsDeleted','user_id','PaymentBatchID']
+USER_COLS   = ['id','name','email','password_hash','currency','pay_currency','created_at','last_login','is_admin','status','lang_pref']
+
+@timed_phase('read_workbook')
+def read_workbook():
     if os.path.exists(EXCEL_FILE):
         xls     = pd.ExcelFile(EXCEL_FILE, engine='openpyxl')
-        clients = pd.read_excel(xls, 'Clients')    if 'Clients'   in xls.sheet_names else pd.DataFrame(columns=client_cols)
-        tasks   = pd.read_excel(xls, 'Tasks')      if 'Tasks'     in xls.sheet_names else pd.DataFrame(columns=task_cols)
-        ts      = pd.read_excel(xls, 'Timesheet')  if 'Timesheet' in xls.sheet_names else pd.DataFrame(columns=ts_cols)
-        users   = pd.read_excel(xls, 'Users')      if 'Users'     in xls.sheet_names else pd.DataFrame(columns=user_cols)
+        clients = pd.read_excel(xls, 'Clients')    if 'Clients'   in xls.sheet_names else pd.DataFrame(columns=CLIENT_COLS)
+        tasks   = pd.read_excel(xls, 'Tasks')      if 'Tasks'     in xls.sheet_names else pd.DataFrame(columns=TASK_COLS)
+        ts      = pd.read_excel(xls, 'Timesheet')  if 'Timesheet' in xls.sheet_names else pd.DataFrame(columns=TS_COLS)
+        users   = pd.read_excel(xls, 'Users')      if 'Users'     in xls.sheet_names else pd.DataFrame(columns=USER_COLS)
     else:
-        clients = pd.DataFrame(columns=client_cols)
-        tasks   = pd.DataFrame(columns=task_cols)
-        ts      = pd.DataFrame(columns=ts_cols)
-        users   = pd.DataFrame(columns=user_cols)
+        clients = pd.DataFrame(columns=CLIENT_COLS)
+        tasks   = pd.DataFrame(columns=TASK_COLS)
+        ts      = pd.DataFrame(columns=TS_COLS)
+        users   = pd.DataFrame(columns=USER_COLS)
 
     # ensure required columns
-    for df, cols in ((clients,client_cols),(tasks,task_cols),(ts,ts_cols),(users,user_cols)):
+    for df, cols in ((clients,CLIENT_COLS),(tasks,TASK_COLS),(ts,TS_COLS),(users,USER_COLS)):
         for c in cols:
             if c not in df.columns:
                 df[c] = pd.NA
@@ -112,6 +230,7 @@ def load_data():
     # sanitize tasks
     tasks.Status      = tasks.Status.fillna('Pending')
     tasks.ShortName   = tasks.ShortName.fillna('')
+    tasks.TaskDescription = tasks.TaskDescription.fillna('')
     tasks.CreatedDate = tasks.CreatedDate.fillna('')
     tasks.IsDeleted   = tasks.IsDeleted.fillna(False)
 
@@ -121,16 +240,53 @@ def load_data():
     ts.Description = ts.Description.fillna('')
     ts.Date        = ts.Date.fillna('')
     ts.IsDeleted   = ts.IsDeleted.fillna(False)
+    ts.PaymentBatchID = ts.PaymentBatchID.fillna('')
 
     return clients, tasks, ts, users
 
+@timed_phase('save_data')
 def save_data(clients, tasks, ts, users):
+    prev_version = data_version()
     os.makedirs(os.path.dirname(EXCEL_FILE), exist_ok=True)
     with pd.ExcelWriter(EXCEL_FILE, engine='openpyxl') as w:
         clients.to_excel(w, sheet_name='Clients', index=False)
         tasks.to_excel(w, sheet_name='Tasks', index=False)
         ts.to_excel(w, sheet_name='Timesheet', index=False)
         users.to_excel(w, sheet_name='Users', index=False)
+    advance_search_indexes(prev_version)
+
+PAYMENT_COLS = ['BatchID','user_id','CreatedAt','ClientID','Month','EntryCount','TotalHours','TotalEarnings','Currency']
+
+def load_payments():
+    """Settlement batches (one row per bulk 'mark paid'), kept beside the main workbook."""
+    if not os.path.exists(PAYMENTS_FILE):
+        return pd.DataFrame(columns=PAYMENT_COLS)
+    payments = pd.read_excel(PAYMENTS_FILE, engine='openpyxl')
+    for c in PAYMENT_COLS:
+        if c not in payments.columns:
+            payments[c] = pd.NA
+    payments.ClientID = payments.ClientID.fillna('')
+    payments.Month    = payments.Month.fillna('')
+    return payments
+
+def save_payments(payments):
+    os.makedirs(os.path.dirname(PAYMENTS_FILE), exist_ok=True)
+    payments.to_excel(PAYMENTS_FILE, sheet_name='Payments', index=False, engine='openpyxl')
+
+def data_version() -> str:
+    """Token identifying the workbook on disk; changes on every save_data."""
+    try:
+        st = os.stat(EXCEL_FILE)
+    except FileNotFoundError:
+        return '0'
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+def data_mtime() -> datetime | None:
+    """Last-Modified for pages rendered from the workbook."""
+    try:
+        return datetime.fromtimestamp(os.path.getmtime(EXCEL_FILE), timezone.utc)
+    except FileNotFoundError:
+        return None
 
 # ── Helpers ───────────────────────────────────────────────────────────────────
 def login_required(f):
@@ -142,6 +298,42 @@ def login_required(f):
         return f(*args, **kwargs)
     return wrapped
 
+def is_truthy(value) -> bool:
+    """Interpret a flag cell read back from Excel (bool, 0/1, 'True', NaN)."""
+    if pd.isna(value):
+        return False
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1', 'yes')
+    return bool(value)
+
+def is_admin_user(user_id) -> bool:
+    _, (_, _, _, users) = current_frames()
+    row = users[users.id == user_id]
+    return not row.empty and is_truthy(row.iloc[0].is_admin)
+
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def wrapped(*args, **kwargs):
+        if not is_admin_user(session['user_id']):
+            flash('Admins only.', 'danger')
+            return redirect(url_for('view_tasks'))
+        return f(*args, **kwargs)
+    return wrapped
+
+def compute_earnings(df):
+    """
+    Add Earnings / PaidEarnings to a frame carrying Hours, Paid,
+    PaymentType and PaymentAmount. Monthly & Project clients earn their
+    flat amount for any entry with hours; Hourly clients earn hours × rate.
+    """
+    hours  = df.Hours.astype(float)
+    amount = df.PaymentAmount.astype(float)
+    flat   = df.PaymentType.isin(['Monthly','Project']) & (hours > 0)
+    df['Earnings']     = amount.where(flat, hours * amount)
+    df['PaidEarnings'] = df.Earnings.where(df.Paid.map(is_truthy), 0.0)
+    return df
+
 def load_user_data():
     """Load only the current user's non-deleted clients/tasks/timesheet."""
     clients, tasks, ts, users = load_data()
@@ -151,6 +343,292 @@ def load_user_data():
     ts      = ts[(ts.user_id==me)&(~ts.IsDeleted)]
     return clients, tasks, ts, users
 
+# ── Client Hierarchy ─────────────────────────────────────────────────────────
+class ClientTree:
+    """
+    Ancestor/descendant closure over the live clients (agency → client →
+    project → …). Every ancestor/descendant pair is precomputed, so
+    subtree and root lookups are dict hits instead of ParentID walks.
+    """
+    def __init__(self, clients):
+        live = clients[~clients.IsDeleted]
+        self.names  = dict(zip(live.ClientID, live.ClientName))
+        self.parent = dict(zip(live.ClientID, live.ParentID))
+
+        self._children: dict[str, list[str]] = {}
+        for cid, pid in self.parent.items():
+            if pid in self.parent:
+                self._children.setdefault(pid, []).append(cid)
+
+        # closure rows: self at depth 0, then each ancestor up to the root
+        self._ancestors: dict[str, list[str]] = {}
+        for cid in self.parent:
+            chain, node = [], cid
+            while node in self.parent and node not in chain:
+                chain.append(node)
+                node = self.parent[node]
+            self._ancestors[cid] = chain
+
+        # pre-order position, so descendant lists come out tree-shaped
+        order, stack = {}, [c for c in reversed(list(self.parent)) if self.depth(c) == 0]
+        while stack:
+            node = stack.pop()
+            if node in order:
+                continue
+            order[node] = len(order)
+            stack.extend(reversed(self._children.get(node, [])))
+
+        self._descendants: dict[str, list[str]] = {cid: [] for cid in self.parent}
+        for cid in sorted(self.parent, key=lambda c: order.get(c, len(order))):
+            for anc in self._ancestors[cid]:
+                self._descendants[anc].append(cid)
+
+    def __contains__(self, cid):
+        return cid in self.parent
+
+    def ancestors(self, cid, include_self=True) -> list[str]:
+        chain = self._ancestors.get(cid, [])
+        return chain if include_self else chain[1:]
+
+    def descendants(self, cid, include_self=True) -> list[str]:
+        """Whole subtree of `cid` in pre-order (self first)."""
+        sub = self._descendants.get(cid, [])
+        return sub if include_self else sub[1:]
+
+    def children(self, cid) -> list[str]:
+        return self._children.get(cid, [])
+
+    def root(self, cid) -> str:
+        chain = self._ancestors.get(cid)
+        return chain[-1] if chain else cid
+
+    def depth(self, cid) -> int:
+        return max(len(self._ancestors.get(cid, [])) - 1, 0)
+
+    def flatten(self, client_ids) -> list[tuple[str, int]]:
+        """(ClientID, depth) in tree order for the given clients' forest."""
+        wanted = set(client_ids)
+        return [
+            (cid, self.depth(cid))
+            for root in client_ids if self.depth(root) == 0
+            for cid in self.descendants(root) if cid in wanted
+        ]
+
+_client_tree_cache: dict[str, ClientTree] = {}
+
+def get_client_tree(clients_all=None) -> ClientTree:
+    """ClientTree for the current data_version(), built once per version."""
+    version = data_version()
+    tree = _client_tree_cache.get(version)
+    if tree is None:
+        if clients_all is None:
+            clients_all, _, _, _ = load_data()
+        tree = ClientTree(clients_all)
+        _client_tree_cache.clear()
+        _client_tree_cache[version] = tree
+    return tree
+
+def refresh_client_tree(clients_all) -> ClientTree:
+    """Rebuild the closure right after a client add/edit/delete is saved."""
+    _client_tree_cache.clear()
+    return get_client_tree(clients_all)
+
+def client_rows(clients, tree):
+    """User's clients as records in tree order, with Depth & ParentName."""
+    by_id = clients.set_index('ClientID', drop=False).to_dict('index')
+    return [
+        {**by_id[cid], 'Depth': depth, 'ParentName': tree.names.get(tree.parent[cid], '')}
+        for cid, depth in tree.flatten(list(clients.ClientID))
+    ]
+
+# ── HTTP Caching & Compression ───────────────────────────────────────────────
+STATIC_MAX_AGE     = 365 * 24 * 3600   # fingerprinted URLs never change content
+COMPRESS_MIN_SIZE  = 500
+COMPRESS_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript',
+    'application/json', 'application/javascript', 'image/svg+xml',
+}
+# probes, side effects, cross-tenant pages and Data/profiles listings that a
+# per-user validator can't describe
+NO_CONDITIONAL = {
+    'static', 'logout', 'healthz', 'readyz',
+    'admin_analytics', 'admin_analytics_json',
+    'admin_profiles', 'download_profile',
+}
+
+def fingerprint_dirs(*dirs) -> str:
+    """Short hash over file names & mtimes, so a deploy invalidates page ETags."""
+    h = hashlib.sha1()
+    for d in dirs:
+        for root, _, files in sorted(os.walk(d)):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                h.update(f'{path}:{os.stat(path).st_mtime_ns}'.encode())
+    return h.hexdigest()[:12]
+
+_ASSET_VERSION = fingerprint_dirs(
+    os.path.join(app.root_path, app.template_folder), app.static_folder
+)
+
+_static_hashes: dict[str, tuple[int, str]] = {}
+
+def static_fingerprint(filename: str) -> str:
+    """Content hash of a static file, recomputed only when its mtime moves."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return ''
+    cached = _static_hashes.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:10]
+    _static_hashes[filename] = (mtime, digest)
+    return digest
+
+@app.url_defaults
+def add_static_fingerprint(endpoint, values):
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        values['v'] = static_fingerprint(values['filename'])
+
+def page_etag() -> str | None:
+    """
+    Validator for a logged-in GET page: same user, same per-user data
+    version, same templates and same URL render the same HTML. The hour is
+    mixed in for exchange rates and today's date; pending flashes disable it.
+    """
+    if (request.method != 'GET' or request.endpoint in NO_CONDITIONAL
+            or not session.get('user_id') or session.get('_flashes')
+            or profiling_requested()):
+        return None
+    key = '|'.join((
+        session['user_id'], user_data_version(session['user_id']), _ASSET_VERSION,
+        datetime.now().strftime('%Y%m%d%H'), request.full_path
+    ))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+@app.before_request
+def serve_not_modified():
+    """Answer 304 before the view runs when the page can't have changed."""
+    g.page_etag = page_etag()
+    if g.page_etag and not is_resource_modified(
+        request.environ, etag=g.page_etag,
+        last_modified=user_data_mtime(session['user_id'])
+    ):
+        resp = app.response_class(status=304)
+        resp.set_etag(g.page_etag, weak=True)
+        return resp
+
+def compress_response(response):
+    """Brotli (if installed) or gzip for text responses the client accepts."""
+    if (response.status_code != 200
+            or response.mimetype not in COMPRESS_MIMETYPES
+            or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if brotli is not None and request.accept_encodings['br']:
+        encoding = 'br'
+    elif request.accept_encodings['gzip']:
+        encoding = 'gzip'
+    else:
+        return response
+
+    response.direct_passthrough = False
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(brotli.compress(data) if encoding == 'br' else gzip.compress(data, 6))
+    response.headers['Content-Encoding'] = encoding
+    # the bytes differ per encoding, so only a weak validator still holds
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.after_request
+def add_cache_headers(response):
+    if g.get('page_etag') and response.status_code == 200 and not response.direct_passthrough:
+        response.set_etag(g.page_etag, weak=True)
+        response.last_modified = user_data_mtime(session['user_id'])
+        response.cache_control.private  = True
+        response.cache_control.no_cache = True
+    elif request.endpoint == 'static' and request.args.get('v'):
+        response.cache_control.no_cache = None
+        response.cache_control.public   = True
+        response.cache_control.max_age  = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return compress_response(response)
+
+# ── Template Fragment Cache ──────────────────────────────────────────────────
+FRAGMENT_CACHE_BYTES = int(os.environ.get('FRAGMENT_CACHE_BYTES', 32 * 1024 * 1024))
+
+class FragmentCache:
+    """Thread-safe LRU of rendered HTML, bounded by total UTF-8 bytes held."""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size      = 0
+        self._items: OrderedDict[tuple, tuple[str, int]] = OrderedDict()
+        self._lock     = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, html):
+        nbytes = len(html.encode('utf-8'))
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._items[key] = (html, nbytes)
+            self.size += nbytes
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.size -= evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+_fragment_cache = FragmentCache(FRAGMENT_CACHE_BYTES)
+
+class FragmentCacheExtension(Extension):
+    """
+    {% cache 'name', part, ... %}…{% endcache %} renders the block once per
+    (user, name, parts, user_data_version, templates) and serves it from
+    _fragment_cache until that user's data changes.
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts  = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render_cached', [nodes.List(parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render_cached(self, parts, caller):
+        uid  = session.get('user_id', '')
+        key  = (uid, *map(str, parts), user_data_version(uid) if uid else data_version(), _ASSET_VERSION)
+        html = _fragment_cache.get(key)
+        if html is None:
+            html = caller()
+            _fragment_cache.put(key, html)
+        return Markup(html)
+
+app.jinja_env.add_extension(FragmentCacheExtension)
+
 @app.route('/', methods=['GET'])
 def home():
     return redirect(url_for('login_register'))
@@ -284,7 +762,7 @@ def view_clients():
     clients = clients_all[(clients_all.user_id == me) & (~clients_all.IsDeleted)]
     cmap    = {r.ClientID: r.ClientName for _, r in clients.iterrows()}
     return render_template('view_clients.html',
-        clients     = clients.to_dict('records'),
+        clients     = client_rows(clients, get_client_tree(clients_all)),
         clients_map = cmap
     )
 
@@ -306,17 +784,17 @@ def add_client():
             me
         ]
         save_data(clients_all, tasks_all, ts_all, users)
+        refresh_client_tree(clients_all)
         flash('Client added.', 'success')
         return redirect(url_for('view_clients'))
 
-    # for the dropdown, only top-level parents of this user
+    # any of this user's clients can be a parent
     parents = clients_all[
         (clients_all.user_id == me) &
-        (clients_all.ParentID == '') &
         (~clients_all.IsDeleted)
     ]
     return render_template('add_client.html',
-        clients = parents.to_dict('records')
+        clients = client_rows(parents, get_client_tree(clients_all))
     )
 
 @app.route('/clients/<client_id>/edit', methods=['GET','POST'])
@@ -333,28 +811,35 @@ def edit_client(client_id):
         flash('Client not found.', 'warning')
         return redirect(url_for('view_clients'))
     client = df.iloc[0]
+    tree   = get_client_tree(clients_all)
+    # a client can't move under itself or anything in its own subtree
+    subtree = tree.descendants(client_id)
 
     if request.method == 'POST':
+        parent_id = request.form.get('parent_id','')
+        if parent_id in subtree:
+            flash('A client cannot be nested under itself or its sub-clients.', 'warning')
+            return redirect(url_for('edit_client', client_id=client_id))
         mask = (
             (clients_all.ClientID == client_id) &
             (clients_all.user_id   == me)
         )
         clients_all.loc[mask,'ClientName']    = request.form['name'].strip()
-        clients_all.loc[mask,'ParentID']      = request.form.get('parent_id','')
+        clients_all.loc[mask,'ParentID']      = parent_id
         clients_all.loc[mask,'PaymentType']   = request.form.get('rate_type','Hourly')
         clients_all.loc[mask,'PaymentAmount'] = float(request.form.get('rate_amount',0) or 0)
         save_data(clients_all, tasks_all, ts_all, users)
+        refresh_client_tree(clients_all)
         flash('Client updated.', 'success')
         return redirect(url_for('view_clients'))
 
     parents = clients_all[
         (clients_all.user_id == me) &
-        (clients_all.ParentID == '') &
-        (clients_all.ClientID != client_id) &
+        (~clients_all.ClientID.isin(subtree)) &
         (~clients_all.IsDeleted)
     ]
     return render_template('edit_client.html',
-        clients = parents.to_dict('records'),
+        clients = client_rows(parents, tree),
         client  = client
     )
 
@@ -365,11 +850,7 @@ def delete_client(client_id):
     me = session['user_id']
 
     # block if children
-    if not clients_all[
-        (clients_all.ParentID == client_id) &
-        (clients_all.user_id   == me) &
-        (~clients_all.IsDeleted)
-    ].empty:
+    if get_client_tree(clients_all).children(client_id):
         flash('Cannot delete parent with children.', 'warning')
     # block if tasks
     elif not tasks_all[
@@ -385,6 +866,7 @@ def delete_client(client_id):
             'IsDeleted'
         ] = True
         save_data(clients_all, tasks_all, ts_all, users)
+        refresh_client_tree(clients_all)
         flash('Client deleted.', 'success')
 
     return redirect(url_for('view_clients'))
@@ -435,6 +917,7 @@ def add_task():
             me
         ]
         save_data(clients_all, tasks_all, ts_all, users)
+        reindex_tasks(tasks_all, [tid])
         flash('Task added.', 'success')
         return redirect(url_for('view_tasks'))
 
@@ -462,6 +945,7 @@ def edit_task(task_id):
     tasks_all.loc[mask,'ShortName']       = request.form.get('short_name','').strip()
     tasks_all.loc[mask,'Status']          = request.form.get('status')
     save_data(clients_all, tasks_all, ts_all, users)
+    reindex_tasks(tasks_all, [task_id])
     flash('Task updated.', 'success')
     return redirect(url_for('view_tasks'))
 
@@ -478,6 +962,7 @@ def delete_task(task_id):
 
     tasks_all.loc[tasks_all.TaskID == task_id, 'IsDeleted'] = True
     save_data(clients_all, tasks_all, ts_all, users)
+    reindex_tasks(tasks_all, [task_id])
     return jsonify(success=True)
 
 
@@ -523,11 +1008,13 @@ def log_hours():
             desc,
             False,      # Paid
             False,      # IsDeleted
-            me          # user_id
+            me,         # user_id
+            ''          # PaymentBatchID
         ]
 
         # 5) Save **all** sheets back
         save_data(clients_all, tasks_all, ts_all, users)
+        reindex_entries(ts_all, [entry_id])
         flash('Hours logged.', 'success')
         return redirect(url_for('view_timesheet'))
 
@@ -564,26 +1051,26 @@ def view_timesheet():
     )
     df['Date'] = pd.to_datetime(df['Date']).dt.strftime('%Y-%m-%d')
 
-    parent_map = clients.set_index('ClientID')['ParentID'].to_dict()
-    def find_parent(cid): return parent_map.get(cid,'') or cid
-    df['ParentID'] = df['ClientID'].apply(find_parent)
+    tree = get_client_tree(clients_all)
+    df = df[df['ClientID'].isin(clients.ClientID)]
+    df['ParentID'] = df['ClientID'].map(tree.root)
+    by_client = dict(tuple(df.groupby('ClientID')))
 
     grouped = []
-    for pid, pdf in df.groupby('ParentID'):
-        children = []
-        for cid, cdf in pdf.groupby('ClientID'):
-            children.append({
-                'ClientID':   cid,
-                'ClientName': clients.set_index('ClientID').loc[cid,'ClientName'],
-                'Entries':    cdf.to_dict('records')
-            })
+    for pid in df['ParentID'].unique():
+        children = [{
+            'ClientID':   cid,
+            'ClientName': tree.names[cid],
+            'Depth':      tree.depth(cid),
+            'Entries':    by_client[cid].to_dict('records')
+        } for cid in tree.descendants(pid) if cid in by_client]
         grouped.append({
             'ParentID':   pid,
-            'ParentName': clients.set_index('ClientID').loc[pid,'ClientName'],
+            'ParentName': tree.names[pid],
             'Children':   children
         })
 
-    return render_template('view_timesheet.html', clients_list=clients.to_dict('records') , groups=grouped)
+    return render_template('view_timesheet.html', clients_list=client_rows(clients, tree), groups=grouped)
 
 
 @app.route('/timesheet/mark_paid/<entry_id>', methods=['POST'])
@@ -600,6 +1087,109 @@ def mark_paid(entry_id):
     return redirect(url_for('view_timesheet'))
 
 
+MONTH_RE = re.compile(r'\d{4}-(0[1-9]|1[0-2])')
+
+@app.route('/timesheet/settle', methods=['POST'])
+@login_required
+def settle_entries():
+    """
+    Mark every unpaid entry matching client (incl. sub-clients), month
+    and/or an explicit entry_id list as paid in one workbook write, and
+    record the batch in the payments file for later reconciliation.
+    """
+    def bad_request(message):
+        if request.is_json:
+            return jsonify(error=message), 400
+        flash(message + '.', 'warning')
+        return redirect(url_for('view_timesheet'))
+
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return bad_request('Expected a JSON object')
+        client_id = body.get('client_id', '')
+        month     = body.get('month', '')
+        entry_ids = body.get('entry_ids', [])
+    else:
+        client_id = request.form.get('client_id', '')
+        month     = request.form.get('month', '')
+        entry_ids = request.form.getlist('entry_id')
+
+    if not isinstance(client_id, str):
+        return bad_request('client_id must be a string')
+    if not isinstance(month, str) or (month and not MONTH_RE.fullmatch(month)):
+        return bad_request('month must be YYYY-MM')
+    if not isinstance(entry_ids, list) or not all(isinstance(e, str) for e in entry_ids):
+        return bad_request('entry_ids must be a list of strings')
+    if not (client_id or month or entry_ids):
+        return bad_request('Choose a client, a month or entries to settle')
+
+    clients_all, tasks_all, ts_all, users = load_data()
+    me = session['user_id']
+
+    df = ts_all[
+        (ts_all.user_id == me) &
+        (~ts_all.IsDeleted) &
+        (~ts_all.Paid.map(is_truthy))
+    ].merge(
+        tasks_all[['TaskID','ClientID']], on='TaskID'
+    ).merge(
+        clients_all[['ClientID','PaymentType','PaymentAmount']], on='ClientID'
+    )
+    if client_id:
+        df = df[df.ClientID.isin(get_client_tree(clients_all).descendants(client_id))]
+    if month:
+        df = df[pd.to_datetime(df.Date).dt.strftime('%Y-%m') == month]
+    if entry_ids:
+        df = df[df.EntryID.isin(entry_ids)]
+
+    if df.empty:
+        if request.is_json:
+            return jsonify(entries=0, hours=0.0, earnings=0.0, batch_id=None)
+        flash('Nothing to settle.', 'info')
+        return redirect(url_for('view_timesheet'))
+
+    df = compute_earnings(df)
+    user     = users[users.id == me].iloc[0]
+    currency = user.pay_currency or user.currency or 'USD'
+    batch_id = str(uuid.uuid4())
+    totals   = {
+        'entries':  int(len(df)),
+        'hours':    float(df.Hours.sum()),
+        'earnings': float(df.Earnings.sum()),
+    }
+
+    # batch first: a crash between the two writes leaves an orphan batch, never unbatched paid rows
+    payments = load_payments()
+    payments.loc[len(payments)] = [
+        batch_id, me, datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        client_id, month, totals['entries'], totals['hours'], totals['earnings'], currency
+    ]
+    save_payments(payments)
+
+    mask = ts_all.EntryID.isin(df.EntryID)
+    ts_all.loc[mask, 'Paid']           = True
+    ts_all.loc[mask, 'PaymentBatchID'] = batch_id
+    save_data(clients_all, tasks_all, ts_all, users)
+
+    if request.is_json:
+        return jsonify(batch_id=batch_id, currency=currency, **totals)
+    flash(
+        f"Settled {totals['entries']} entries: {totals['hours']:.2f} h, "
+        f"{totals['earnings']:.2f} {get_currency_symbol(currency)}.",
+        'success'
+    )
+    return redirect(url_for('view_timesheet'))
+
+
+@app.route('/timesheet/payments.json')
+@login_required
+def payment_batches():
+    payments = load_payments()
+    mine = payments[payments.user_id == session['user_id']].sort_values('CreatedAt', ascending=False)
+    return jsonify(batches=mine.to_dict('records'))
+
+
 @app.route('/timesheet/entry/<entry_id>/delete', methods=['POST'])
 @login_required
 def delete_entry(entry_id):
@@ -613,6 +1203,7 @@ def delete_entry(entry_id):
     else:
         ts_all.loc[mask, 'IsDeleted'] = True
         save_data(clients_all, tasks_all, ts_all, users)
+        reindex_entries(ts_all, [entry_id])
         flash('Entry deleted.', 'success')
 
     return redirect(url_for('view_timesheet'))
@@ -637,6 +1228,7 @@ def edit_entry(entry_id):
         ts_all.loc[mask, 'Description'] = request.form.get('description', entry['Description']).strip()
 
         save_data(clients_all, tasks_all, ts_all, users)
+        reindex_entries(ts_all, [entry_id])
         flash('Entry updated.', 'success')
         return redirect(url_for('view_timesheet'))
 
@@ -646,7 +1238,8 @@ def edit_entry(entry_id):
 @app.route('/timesheet/export')
 @login_required
 def export_timesheet():
-    clients, tasks, ts, users = load_user_data()
+    month = request.args.get('month')
+    clients, tasks, ts, users, tree = load_report_data([month] if month else [])
     me = session['user_id']
 
     # Prepare DataFrame
@@ -661,18 +1254,12 @@ def export_timesheet():
     client_id   = request.args.get('client_id')  # this can be either a parent or a leaf
     client_name = "all-clients"
     if client_id:
-        # if the chosen client_id is actually a parent, include all its children
-        is_parent   = client_id in clients.ParentID.values
-        if is_parent:
-            child_ids = clients.loc[clients.ParentID == client_id, 'ClientID'].tolist()
-            df = df[df.ClientID.isin([client_id] + child_ids)]
-        else:
-            df = df[df.ClientID == client_id]
+        # the chosen client plus everything nested under it
+        df = df[df.ClientID.isin(tree.descendants(client_id))]
         client_name = clients.loc[clients.ClientID == client_id, 'ClientName'].iloc[0].replace(" ", "_")
 
 
     # Filter by month if provided
-    month = request.args.get('month')
     month_label = month or "all-months"
     if month:
         df = df[df.Month == month]
@@ -698,10 +1285,7 @@ def export_timesheet():
             rows = []
             # Determine each row's true parent_id
             sheet_df = sheet_df.copy()
-            sheet_df['EffectiveParent'] = sheet_df.apply(
-                lambda r: r.ClientID if r.ParentID == '' else r.ParentID,
-                axis=1
-            )
+            sheet_df['EffectiveParent'] = sheet_df.ClientID.map(tree.root)
             # Group all entries by that EffectiveParent
             grouped_by_parent = {
                 pid: group
@@ -709,13 +1293,10 @@ def export_timesheet():
             }
 
             # Sort parents by name
-            parent_order = sorted(
-                grouped_by_parent.keys(),
-                key=lambda pid: clients.set_index('ClientID').loc[pid, 'ClientName']
-            )
+            parent_order = sorted(grouped_by_parent.keys(), key=tree.names.get)
 
             for pid in parent_order:
-                parent_name = clients.loc[clients.ClientID == pid, 'ClientName'].iloc[0]
+                parent_name = tree.names[pid]
                 # Insert a header row for this parent
                 rows.append({
                     'ParentName': parent_name,
@@ -773,14 +1354,14 @@ def export_timesheet():
 @app.route('/reports/monthly')
 @login_required
 def monthly_summary():
-    clients, tasks, ts, users = load_user_data()
+    sel_months  = request.args.getlist('month')
+    clients, tasks, ts, users, tree = load_report_data(sel_months)
     me = session['user_id']
     user_row = users[users.id==me].iloc[0]
     user_curr = user_row.currency or 'USD'
     exc_rate = 1.0 if user_curr.upper()=='USD' else fetch_exchange_rate(user_curr)
 
     name_map  = clients.set_index('ClientID').ClientName.to_dict()
-    children  = clients[clients.ParentID!=''].groupby('ParentID').ClientID.apply(list).to_dict()
 
     df = ts[['TaskID','Date','Hours','Paid']].merge(
          tasks[['TaskID','ClientID']], on='TaskID'
@@ -789,13 +1370,7 @@ def monthly_summary():
     )
     df['Date']  = pd.to_datetime(df.Date)
     df['Month'] = df.Date.dt.to_period('M').astype(str)
-    df['Earnings'] = df.apply(
-        lambda r: r.PaymentAmount
-                  if r.PaymentType in ('Monthly','Project') and r.Hours>0
-                  else r.Hours * r.PaymentAmount,
-        axis=1
-    )
-    df['PaidEarnings'] = df.apply(lambda r: r.Earnings if r.Paid else 0.0, axis=1)
+    df = compute_earnings(df)
 
     agg = df.groupby(['Month','ClientID'], as_index=False).agg(
         TotalHours    = ('Hours','sum'),
@@ -803,10 +1378,9 @@ def monthly_summary():
         TotalPaid     = ('PaidEarnings','sum')
     )
 
-    month_list  = sorted(df.Month.unique(), reverse=True)
-    parent_ids  = [p for p in clients.ClientID if clients.set_index('ClientID').loc[p,'ParentID']=='' ]
+    month_list  = sorted(set(df.Month) | set(archived_months(me)), reverse=True)
+    parent_ids  = [p for p in clients.ClientID if tree.depth(p) == 0]
     parent_names= [name_map[p] for p in parent_ids]
-    sel_months  = request.args.getlist('month')
     sel_clients = request.args.getlist('client')
 
     summary=[]
@@ -814,13 +1388,14 @@ def monthly_summary():
         if sel_months and month not in sel_months: continue
         for p in parent_ids:
             if sel_clients and name_map[p] not in sel_clients: continue
-            sub = mdf[mdf.ClientID.isin(children.get(p,[]))]
+            sub = mdf.set_index('ClientID')
             children_list = [{
-                'ClientName':    name_map[r.ClientID],
-                'TotalHours':    r.TotalHours,
-                'TotalEarnings': r.TotalEarnings,
-                'TotalPaid':     r.TotalPaid
-            } for _,r in sub.iterrows()]
+                'ClientName':    name_map[cid],
+                'Depth':         tree.depth(cid),
+                'TotalHours':    sub.at[cid,'TotalHours'],
+                'TotalEarnings': sub.at[cid,'TotalEarnings'],
+                'TotalPaid':     sub.at[cid,'TotalPaid']
+            } for cid in tree.descendants(p, include_self=False) if cid in sub.index]
             own = mdf[mdf.ClientID==p]
             own_h = float(own.TotalHours.sum())    if not own.empty else 0.0
             own_e = float(own.TotalEarnings.sum()) if not own.empty else 0.0
@@ -830,6 +1405,7 @@ def monthly_summary():
             tot_p = own_p + sum(c['TotalPaid']     for c in children_list)
             summary.append({
                 'Month':         month,
+                'ParentID':      p,
                 'ParentName':    name_map[p],
                 'Children':      children_list,
                 'OwnHours':      own_h,
@@ -868,6 +1444,665 @@ def pending_count():
     count = int((tasks.Status!='Completed').sum())
     return jsonify(pending=count)
 
+# ── Archive ──────────────────────────────────────────────────────────────────
+ARCHIVE_SHEETS = (('Clients', CLIENT_COLS), ('Tasks', TASK_COLS), ('Timesheet', TS_COLS))
+
+# Parsed archive keyed on its file version, like _snapshot for the workbook.
+_archive_snapshot: dict[str, tuple] = {}
+
+def archive_version() -> str:
+    try:
+        st = os.stat(ARCHIVE_FILE)
+    except FileNotFoundError:
+        return '0'
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}'
+
+def load_archive():
+    """
+    Cold clients / tasks / timesheet rows moved out by `flask archive`.
+    The frames are shared until the archive changes: never mutate them.
+    """
+    version = archive_version()
+    frames  = _archive_snapshot.get(version)
+    if frames is not None:
+        return frames
+    if version == '0':
+        frames = tuple(pd.DataFrame(columns=cols) for _, cols in ARCHIVE_SHEETS)
+    else:
+        xls = pd.ExcelFile(ARCHIVE_FILE, engine='openpyxl')
+        frames = tuple(
+            pd.read_excel(xls, name).reindex(columns=cols)
+            if name in xls.sheet_names else pd.DataFrame(columns=cols)
+            for name, cols in ARCHIVE_SHEETS
+        )
+    _archive_snapshot.clear()
+    _archive_snapshot[version] = frames
+    return frames
+
+def load_archive_meta() -> dict:
+    if not os.path.exists(ARCHIVE_META):
+        return {}
+    with open(ARCHIVE_META, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def archived_months(user_id) -> list[str]:
+    return load_archive_meta().get('months', {}).get(user_id, [])
+
+def load_report_data(months):
+    """
+    load_user_data() plus the ClientTree to roll up with. When `months`
+    (empty = all) reach into archived months, the user's archived entries
+    are merged in, together with any tasks/clients deleted since.
+    """
+    clients, tasks, ts, users = load_user_data()
+    me = session['user_id']
+    cold = set(archived_months(me))
+    if not cold or (months and cold.isdisjoint(months)):
+        return clients, tasks, ts, users, get_client_tree()
+
+    clients, tasks, ts = merge_archive(clients, tasks, ts, [me])
+    return clients, tasks, ts, users, ClientTree(clients)
+
+def merge_archive(clients, tasks, ts, user_ids):
+    """
+    Live (non-deleted) clients/tasks/timesheet of `user_ids` plus their
+    archived entries, together with any tasks/clients deleted since.
+    """
+    a_clients, a_tasks, a_ts = load_archive()
+    a_clients = a_clients[a_clients.user_id.isin(user_ids)]
+    a_tasks   = a_tasks[a_tasks.user_id.isin(user_ids)]
+    # rows of an interrupted or aborted archive run are still in the workbook: it wins
+    hot_ids   = current_frames()[1][2].EntryID
+    a_ts      = a_ts[
+        a_ts.user_id.isin(user_ids) & ~a_ts.IsDeleted.map(is_truthy) & ~a_ts.EntryID.isin(hot_ids)
+    ]
+    a_tasks = a_tasks[
+        a_tasks.TaskID.isin(a_ts.TaskID) & ~a_tasks.TaskID.isin(tasks.TaskID)
+    ].drop_duplicates('TaskID')
+    tasks = pd.concat([tasks, a_tasks.assign(IsDeleted=False)], ignore_index=True)
+
+    # pull in archived clients (and their archived ancestors) the entries still point at
+    needed = set(tasks.ClientID) - set(clients.ClientID)
+    a_clients = a_clients.drop_duplicates('ClientID').set_index('ClientID', drop=False)
+    while needed & set(a_clients.index):
+        found   = a_clients.loc[sorted(needed & set(a_clients.index))]
+        clients = pd.concat([clients, found.assign(IsDeleted=False)], ignore_index=True)
+        needed  = set(found.ParentID) - set(clients.ClientID) - {''}
+
+    ts = pd.concat([ts, a_ts.assign(IsDeleted=False)], ignore_index=True)
+    return clients, tasks, ts
+
+class ArchiveConflict(RuntimeError):
+    """The workbook was saved while `flask archive` was running."""
+
+def archive_data(horizon_days: int = ARCHIVE_HORIZON_DAYS) -> dict:
+    """
+    Move soft-deleted clients/tasks/entries, and paid entries dated more
+    than `horizon_days` ago, from the workbook into ARCHIVE_FILE.
+    Returns the number of rows moved per sheet. Raises ArchiveConflict,
+    leaving the workbook untouched, if it changed since it was read.
+    """
+    version, frames = current_frames()
+    clients_all, tasks_all, ts_all, users = (df.copy() for df in frames)
+    cutoff = pd.Timestamp(datetime.now().date() - timedelta(days=horizon_days))
+    dates  = pd.to_datetime(ts_all.Date, errors='coerce')
+
+    cold_masks = {
+        'Clients':   clients_all.IsDeleted.map(is_truthy),
+        'Tasks':     tasks_all.IsDeleted.map(is_truthy),
+        'Timesheet': ts_all.IsDeleted.map(is_truthy) | (ts_all.Paid.map(is_truthy) & (dates < cutoff)),
+    }
+    hot  = {'Clients': clients_all, 'Tasks': tasks_all, 'Timesheet': ts_all}
+    keys = {'Clients': 'ClientID', 'Tasks': 'TaskID', 'Timesheet': 'EntryID'}
+    moved = {name: int(mask.sum()) for name, mask in cold_masks.items()}
+    if not any(moved.values()):
+        return moved
+
+    # archive is written first: an interrupted run leaves duplicates, never lost rows
+    old = dict(zip(('Clients', 'Tasks', 'Timesheet'), load_archive()))
+    os.makedirs(os.path.dirname(ARCHIVE_FILE), exist_ok=True)
+    with pd.ExcelWriter(ARCHIVE_FILE, engine='openpyxl') as w:
+        for name, df in hot.items():
+            merged = pd.concat([old[name], df[cold_masks[name]]], ignore_index=True)
+            merged.drop_duplicates(keys[name], keep='last').to_excel(w, sheet_name=name, index=False)
+
+    cold_ts = ts_all[cold_masks['Timesheet'] & ~ts_all.IsDeleted.map(is_truthy)]
+    meta    = load_archive_meta()
+    months  = meta.get('months', {})
+    for uid, udf in cold_ts.groupby('user_id'):
+        new = pd.to_datetime(udf.Date, errors='coerce').dropna().dt.strftime('%Y-%m')
+        months[uid] = sorted(set(months.get(uid, [])) | set(new))
+    meta.update(months=months, archived_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    with open(ARCHIVE_META, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+
+    # saving now would drop whatever a request wrote since we read the workbook
+    if data_version() != version:
+        raise ArchiveConflict('the workbook changed while archiving; run the command again')
+    save_data(*(df[~cold_masks[name]] for name, df in hot.items()), users)
+    _search_indexes.clear()
+    return moved
+
+@app.cli.command('archive')
+@click.option('--days', default=ARCHIVE_HORIZON_DAYS, show_default=True,
+              help='Archive paid entries older than this many days.')
+def archive_command(days):
+    """Move soft-deleted rows and old paid entries to Data/archive.xlsx."""
+    try:
+        moved = archive_data(days)
+    except ArchiveConflict as e:
+        raise click.ClickException(str(e))
+    click.echo(', '.join(f'{name}: {n}' for name, n in moved.items()) + ' rows archived.')
+
+# ── Search ───────────────────────────────────────────────────────────────────
+SEARCH_RESULT_LIMIT = 200
+_TOKEN_RE = re.compile(r'\w+')
+
+def tokenize(*texts) -> set[str]:
+    return {t for text in texts if not pd.isna(text) for t in _TOKEN_RE.findall(str(text).lower())}
+
+def iso_date(value) -> str:
+    """Normalise a Date/CreatedDate cell to 'YYYY-MM-DD' ('' if unparseable)."""
+    ts = pd.to_datetime(value, errors='coerce')
+    return '' if pd.isna(ts) else ts.strftime('%Y-%m-%d')
+
+class SearchIndex:
+    """
+    One user's inverted index (token → doc keys) over task ShortName /
+    TaskDescription and timesheet Description. Docs are keyed
+    'task:<TaskID>' / 'entry:<EntryID>' and updated in place; a lock
+    keeps concurrent edits and searches from seeing half-applied changes.
+    """
+    def __init__(self, version: str):
+        self.version  = version
+        self.postings: dict[str, set[str]] = {}
+        self.docs:     dict[str, dict] = {}
+        self._tokens:  dict[str, set[str]] = {}
+        self._lock     = threading.RLock()
+
+    def put(self, key, doc, tokens):
+        with self._lock:
+            self.remove(key)
+            self.docs[key]    = doc
+            self._tokens[key] = tokens
+            for t in tokens:
+                self.postings.setdefault(t, set()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            for t in self._tokens.pop(key, ()):
+                keys = self.postings.get(t)
+                if keys is None:
+                    continue
+                keys.discard(key)
+                if not keys:
+                    del self.postings[t]
+            self.docs.pop(key, None)
+
+    def get(self, key) -> dict | None:
+        with self._lock:
+            return self.docs.get(key)
+
+    def put_task(self, r):
+        self.put(f'task:{r.TaskID}', {
+            'Kind':            'task',
+            'TaskID':          r.TaskID,
+            'ClientID':        r.ClientID,
+            'ShortName':       r.ShortName,
+            'TaskDescription': r.TaskDescription,
+            'Date':            iso_date(r.CreatedDate),
+        }, tokenize(r.ShortName, r.TaskDescription))
+
+    def put_entry(self, r):
+        self.put(f'entry:{r.EntryID}', {
+            'Kind':        'entry',
+            'EntryID':     r.EntryID,
+            'TaskID':      r.TaskID,
+            'Description': r.Description,
+            'Hours':       float(r.Hours),
+            'Date':        iso_date(r.Date),
+        }, tokenize(r.Description))
+
+    def match(self, query) -> set[str]:
+        """Keys containing every query word; the last word may be a prefix."""
+        words = _TOKEN_RE.findall(str(query).lower())
+        if not words:
+            return set()
+        *whole, last = words
+        with self._lock:
+            hits = set().union(*(keys for t, keys in self.postings.items() if t.startswith(last)))
+            for w in whole:
+                hits &= self.postings.get(w, set())
+                if not hits:
+                    break
+        return hits
+
+_search_indexes: dict[str, SearchIndex] = {}
+
+def get_search_index(user_id) -> SearchIndex:
+    """The user's index, rebuilt only if the workbook changed behind our back."""
+    version = data_version()
+    index = _search_indexes.get(user_id)
+    if index is None or index.version != version:
+        _, tasks, ts, _ = load_data()
+        index = SearchIndex(version)
+        for r in tasks[(tasks.user_id == user_id) & (~tasks.IsDeleted)].itertuples():
+            index.put_task(r)
+        for r in ts[(ts.user_id == user_id) & (~ts.IsDeleted)].itertuples():
+            index.put_entry(r)
+        _search_indexes[user_id] = index
+    return index
+
+def advance_search_indexes(prev_version: str):
+    """
+    Called by save_data: indexes that matched the workbook before this
+    process wrote it still match afterwards, except for rows the writing
+    route mirrors itself via reindex_tasks / reindex_entries.
+    """
+    version = data_version()
+    for index in _search_indexes.values():
+        if index.version == prev_version:
+            index.version = version
+
+def reindex_tasks(tasks_all, task_ids):
+    for r in tasks_all[tasks_all.TaskID.isin(task_ids)].itertuples():
+        index = _search_indexes.get(r.user_id)
+        if index is None:
+            continue
+        if r.IsDeleted:
+            index.remove(f'task:{r.TaskID}')
+        else:
+            index.put_task(r)
+
+def reindex_entries(ts_all, entry_ids):
+    for r in ts_all[ts_all.EntryID.isin(entry_ids)].itertuples():
+        index = _search_indexes.get(r.user_id)
+        if index is None:
+            continue
+        if r.IsDeleted:
+            index.remove(f'entry:{r.EntryID}')
+        else:
+            index.put_entry(r)
+
+def run_search(user_id):
+    """Apply ?q=, ?client_id= (incl. sub-clients), ?start= / ?end= to the user's index."""
+    index = get_search_index(user_id)
+    tree  = get_client_tree()
+    query = request.args.get('q', '').strip()
+    start = request.args.get('start', '')
+    end   = request.args.get('end', '')
+    client_id = request.args.get('client_id', '')
+    allowed   = set(tree.descendants(client_id)) if client_id else None
+
+    results = []
+    for key in index.match(query):
+        doc = index.get(key)
+        if doc is None:  # removed since match()
+            continue
+        task = index.get(f"task:{doc['TaskID']}") or {}
+        cid  = task.get('ClientID', '')
+        if allowed is not None and cid not in allowed:
+            continue
+        if (start and doc['Date'] < start) or (end and doc['Date'] > end):
+            continue
+        results.append({
+            **doc,
+            'ClientID':   cid,
+            'ClientName': tree.names.get(cid, ''),
+            'ShortName':  task.get('ShortName', ''),
+        })
+    results.sort(key=lambda d: d['Date'], reverse=True)
+    return query, len(results), results[:SEARCH_RESULT_LIMIT]
+
+@app.route('/search')
+@login_required
+def search():
+    clients, _, _, _ = load_user_data()
+    query, total, results = run_search(session['user_id'])
+    return render_template('search.html',
+        query        = query,
+        total        = total,
+        results      = results,
+        clients      = client_rows(clients, get_client_tree()),
+        sel_client   = request.args.get('client_id', ''),
+        start        = request.args.get('start', ''),
+        end          = request.args.get('end', '')
+    )
+
+@app.route('/search.json')
+@login_required
+def search_json():
+    query, total, results = run_search(session['user_id'])
+    return jsonify(query=query, total=total, results=results)
+
+# ── Admin Analytics ──────────────────────────────────────────────────────────
+ANALYTICS_WORKERS        = int(os.environ.get('ANALYTICS_WORKERS', os.cpu_count() or 2))
+ANALYTICS_PARALLEL_ROWS  = 50_000   # below this, a pool costs more than it saves
+ANALYTICS_PAGE_SIZE      = 100
+
+_analytics_cache: dict[str, pd.DataFrame] = {}
+_user_analytics: dict[str, tuple[str, pd.DataFrame]] = {}
+_analytics_pool: ProcessPoolExecutor | None = None
+
+def aggregate_user_partition(clients, tasks, ts, users):
+    """
+    Hours / earnings per (user, month, payout currency) for one partition
+    of users. Top-level so it can be shipped to a worker process.
+    """
+    df = ts[['user_id','TaskID','Date','Hours','Paid']].merge(
+         tasks[['TaskID','ClientID']], on='TaskID'
+    ).merge(
+         clients[['ClientID','PaymentType','PaymentAmount']], on='ClientID'
+    )
+    df = compute_earnings(df)
+    df['Month'] = pd.to_datetime(df.Date).dt.to_period('M').astype(str)
+
+    currency = users[['id','pay_currency','currency']].rename(columns={'id':'user_id'})
+    currency['Currency'] = currency.pay_currency.fillna(currency.currency).fillna('USD')
+    df = df.merge(currency[['user_id','Currency']], on='user_id', how='left')
+    df['Currency'] = df.Currency.fillna('USD')
+
+    return df.groupby(['user_id','Month','Currency'], as_index=False).agg(
+        Entries       = ('Hours','size'),
+        TotalHours    = ('Hours','sum'),
+        TotalEarnings = ('Earnings','sum'),
+        TotalPaid     = ('PaidEarnings','sum')
+    )
+
+def get_analytics_pool() -> ProcessPoolExecutor:
+    """
+    Lazily start one pool per process. Workers come from a forkserver
+    (spawn where unavailable) so they never inherit a forked copy of a
+    threaded gunicorn worker's locks and state.
+    """
+    global _analytics_pool
+    if _analytics_pool is None:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _analytics_pool = ProcessPoolExecutor(
+            max_workers=ANALYTICS_WORKERS, mp_context=multiprocessing.get_context(method)
+        )
+    return _analytics_pool
+
+def build_user_analytics():
+    """
+    Per-user/month/currency aggregates across every tenant, including
+    entries moved out by `flask archive`. Each user's rows are cached
+    against user_data_version() (plus archive_version() for users with
+    archived months), so a write only re-aggregates the users it touched;
+    when those are many, they are split into partitions and aggregated
+    in a process pool. The merged table is cached per data and archive
+    version.
+    """
+    version = f'{data_version()}/{archive_version()}'
+    cached  = _analytics_cache.get(version)
+    if cached is not None:
+        return cached
+
+    _, (clients, tasks, ts, users) = current_frames()
+    archived = set(load_archive_meta().get('months', {}))
+    digests  = {
+        uid: f"{digest}/{archive_version() if uid in archived else ''}"
+        for uid, digest in user_data_versions().items()
+    }
+    user_ids = set(ts.user_id.dropna().astype(str)) | archived
+    stale    = sorted(
+        uid for uid in user_ids
+        if _user_analytics.get(uid, (None,))[0] != digests.get(uid, '0')
+    )
+
+    if stale:
+        clients = clients[~clients.IsDeleted & clients.user_id.isin(stale)]
+        tasks   = tasks[~tasks.IsDeleted & tasks.user_id.isin(stale)]
+        ts      = ts[~ts.IsDeleted & ts.user_id.isin(stale)]
+        if archived.intersection(stale):
+            clients, tasks, ts = merge_archive(clients, tasks, ts, sorted(archived.intersection(stale)))
+        if len(ts) < ANALYTICS_PARALLEL_ROWS or ANALYTICS_WORKERS < 2:
+            parts = [aggregate_user_partition(clients, tasks, ts, users)]
+        else:
+            chunks = [stale[i::ANALYTICS_WORKERS] for i in range(ANALYTICS_WORKERS)]
+            jobs = [
+                get_analytics_pool().submit(
+                    aggregate_user_partition,
+                    clients[clients.user_id.isin(ids)],
+                    tasks[tasks.user_id.isin(ids)],
+                    ts[ts.user_id.isin(ids)],
+                    users[users.id.isin(ids)]
+                )
+                for ids in chunks if ids
+            ]
+            parts = [j.result() for j in jobs]
+        fresh = pd.concat(parts, ignore_index=True)
+        by_user = dict(tuple(fresh.groupby('user_id')))
+        for uid in stale:
+            _user_analytics[uid] = (digests.get(uid, '0'), by_user.get(uid, fresh.iloc[0:0]))
+    for uid in set(_user_analytics) - user_ids:
+        del _user_analytics[uid]
+
+    parts = [_user_analytics[uid][1] for uid in sorted(user_ids)]
+    if not parts:
+        parts = [aggregate_user_partition(*(df.iloc[0:0] for df in (clients, tasks, ts, users)))]
+    agg = pd.concat(parts, ignore_index=True)
+    agg['TotalPending'] = agg.TotalEarnings - agg.TotalPaid
+    names = users.set_index('id').name.astype(str).to_dict()
+    agg['UserName'] = agg.user_id.map(names).fillna('')
+    agg = agg.sort_values(['Month','UserName'], ascending=[False, True], ignore_index=True)
+
+    _analytics_cache.clear()
+    _analytics_cache[version] = agg
+    return agg
+
+def filter_analytics(agg):
+    """Apply the ?month= / ?user_id= / ?currency= filters shared by both views."""
+    months   = request.args.getlist('month')
+    user_ids = request.args.getlist('user_id')
+    currency = request.args.get('currency')
+    if months:
+        agg = agg[agg.Month.isin(months)]
+    if user_ids:
+        agg = agg[agg.user_id.isin(user_ids)]
+    if currency:
+        agg = agg[agg.Currency == currency.upper()]
+    return agg
+
+@app.route('/admin/analytics')
+@admin_required
+def admin_analytics():
+    agg_all = build_user_analytics()
+    agg     = filter_analytics(agg_all)
+
+    # per-user totals (one row per user & currency), paginated
+    per_user = agg.groupby(['user_id','UserName','Currency'], as_index=False).agg(
+        Months        = ('Month','nunique'),
+        TotalHours    = ('TotalHours','sum'),
+        TotalEarnings = ('TotalEarnings','sum'),
+        TotalPaid     = ('TotalPaid','sum'),
+        TotalPending  = ('TotalPending','sum')
+    ).sort_values('TotalEarnings', ascending=False, ignore_index=True)
+
+    per_month = agg.groupby(['Month','Currency'], as_index=False).agg(
+        Users         = ('user_id','nunique'),
+        TotalHours    = ('TotalHours','sum'),
+        TotalEarnings = ('TotalEarnings','sum'),
+        TotalPaid     = ('TotalPaid','sum'),
+        TotalPending  = ('TotalPending','sum')
+    ).sort_values(['Month','Currency'], ascending=[False, True])
+
+    pages = max(1, -(-len(per_user) // ANALYTICS_PAGE_SIZE))
+    page  = min(max(request.args.get('page', 1, type=int), 1), pages)
+    start = (page - 1) * ANALYTICS_PAGE_SIZE
+
+    return render_template('admin_analytics.html',
+        per_user    = per_user.iloc[start:start + ANALYTICS_PAGE_SIZE].to_dict('records'),
+        per_month   = per_month.to_dict('records'),
+        month_list  = sorted(agg_all.Month.unique(), reverse=True),
+        sel_months  = request.args.getlist('month'),
+        page        = page,
+        pages       = pages,
+        user_count  = per_user.user_id.nunique()
+    )
+
+@app.route('/admin/analytics.json')
+@admin_required
+def admin_analytics_json():
+    agg = filter_analytics(build_user_analytics())
+    return jsonify(
+        version = data_version(),
+        rows    = agg[[
+            'user_id','UserName','Month','Currency','Entries',
+            'TotalHours','TotalEarnings','TotalPaid','TotalPending'
+        ]].to_dict('records')
+    )
+
+# ── Request Profiling ────────────────────────────────────────────────────────
+# Admins append ?_profile=1 (or send `X-Profile: 1`) to any request to run it
+# under cProfile; the .prof and a .json of tags land in PROFILE_DIR.
+PROFILE_LIST_LIMIT = 200
+
+def profiling_requested() -> bool:
+    """
+    The profile flag on a logged-in request. Checked without touching the
+    workbook so the profiler is on before anything parses it; admin rights
+    are verified in stop_profiling.
+    """
+    flag = request.args.get('_profile') or request.headers.get('X-Profile')
+    return bool(flag) and flag != '0' and bool(session.get('user_id'))
+
+@app.before_request
+def start_profiling():
+    if request.endpoint == 'static' or not profiling_requested():
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler already owns this thread
+        return
+    g.profiler       = profiler
+    g.profile_start  = time.perf_counter()
+    g.phase_timings  = {}
+    g.render_started = []
+
+@before_render_template.connect_via(app)
+def _render_started(sender, template, context, **extra):
+    if 'phase_timings' in g:
+        g.render_started.append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def _render_finished(sender, template, context, **extra):
+    if 'phase_timings' in g and g.render_started:
+        record_phase('render', time.perf_counter() - g.render_started.pop())
+
+def profile_row_counts(user_id) -> dict:
+    """Workbook size, overall and for the profiled user, per sheet."""
+    clients, tasks, ts, users = next(iter(_snapshot.values()), (None,) * 4)
+    if clients is None:
+        return {}
+    return {
+        name: {'total': int(len(df)), 'user': int((df.user_id == user_id).sum())}
+        for name, df in (('clients', clients), ('tasks', tasks), ('timesheet', ts))
+    } | {'users': {'total': int(len(users))}}
+
+@app.after_request
+def stop_profiling(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    elapsed = time.perf_counter() - g.profile_start
+    me      = session.get('user_id', '')
+    if not is_admin_user(me):
+        return response
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    name  = f"{stamp}-{request.endpoint or 'unknown'}-{me[:8]}-{uuid.uuid4().hex[:6]}"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
+    meta = {
+        'name':        name,
+        'created_at':  datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'method':      request.method,
+        'path':        request.full_path,
+        'endpoint':    request.endpoint,
+        'status':      response.status_code,
+        'user_id':     me,
+        'user_name':   session.get('user_name', ''),
+        'total_ms':    round(elapsed * 1000, 2),
+        'phases':      {k: {'calls': v['calls'], 'ms': round(v['ms'], 2)} for k, v in g.phase_timings.items()},
+        'rows':        profile_row_counts(me),
+        'data_version': data_version(),
+    }
+    with open(os.path.join(PROFILE_DIR, name + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    response.headers['X-Profile-Name'] = name
+    return response
+
+@app.teardown_request
+def discard_profiler(exc):
+    """A request that raised never reached stop_profiling; don't leave cProfile on."""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+@app.route('/admin/profiles')
+@admin_required
+def admin_profiles():
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith('.json')), reverse=True)
+        for n in names[:PROFILE_LIST_LIMIT]:
+            with open(os.path.join(PROFILE_DIR, n), 'r', encoding='utf-8') as f:
+                profiles.append(json.load(f))
+    return render_template('admin_profiles.html', profiles=profiles)
+
+@app.route('/admin/profiles/<name>')
+@admin_required
+def download_profile(name):
+    if not name.endswith(('.prof', '.json')):
+        abort(404)
+    return send_from_directory(
+        os.path.abspath(PROFILE_DIR), name, as_attachment=name.endswith('.prof')
+    )
+
+# ── Production Entry Point ───────────────────────────────────────────────────
+def warm_caches():
+    """Parse & index everything a first request would otherwise pay for."""
+    current_frames()
+    user_data_versions()
+    get_client_tree()
+    get_currency_list()
+    for root, _, files in os.walk(app.static_folder):
+        for name in files:
+            static_fingerprint(os.path.relpath(os.path.join(root, name), app.static_folder))
+
+def create_app(config: dict | None = None):
+    """
+    WSGI app factory for gunicorn (see wsgi.py / gunicorn.conf.py). With
+    preload_app the caches warmed here live in the master and are
+    inherited by every worker; gc.freeze keeps them out of collections
+    so their pages stay shared. Refuses to start with the development
+    secret key, which would let anyone forge sessions.
+    """
+    if config:
+        app.config.update(config)
+    if app.secret_key in (None, '', DEV_SECRET_KEY):
+        raise RuntimeError('Set the SECRET_KEY environment variable before starting the app.')
+    warm_caches()
+    gc.freeze()
+    return app
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is serving requests."""
+    return jsonify(status='ok')
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: the workbook for the current version is parsed and cached."""
+    try:
+        version, _ = current_frames()  # parses only if _snapshot is stale
+    except Exception as e:
+        return jsonify(status='unavailable', error=str(e)), 503
+    return jsonify(status='ready', version=version)
+
 if __name__=='__main__':
     app.run(host="127.0.0.1", port=5000, debug=True)
 
@@ -0,0 +1,17 @@
+"""
+Gunicorn settings for Task Organizer; every value can be overridden from
+the environment (e.g. WEB_WORKERS=4 WEB_THREADS=8 gunicorn -c gunicorn.conf.py).
+"""
+import os
+
+wsgi_app    = 'wsgi:app'
+bind        = os.environ.get('BIND', '127.0.0.1:8000')
+workers     = int(os.environ.get('WEB_WORKERS', 2))
+threads     = int(os.environ.get('WEB_THREADS', 4))
+timeout     = int(os.environ.get('WEB_TIMEOUT', 60))
+
+# load & index the dataset in the master, share it copy-on-write with workers
+preload_app = True
+
+accesslog   = os.environ.get('ACCESS_LOG', '-')
+errorlog    = os.environ.get('ERROR_LOG', '-')
@@ -0,0 +1,12 @@
+"""
+Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py
+
+With preload_app (the default in gunicorn.conf.py) this module is imported
+once in the gunicorn master, so the workbook snapshot, client tree and
+currency tables are loaded before the workers fork.
+"""
+from app import create_app
+
+app = create_app()